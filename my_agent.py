@@ -6,13 +6,17 @@ os.environ["CREWAI_TELEMETRY_OPT_OUT"] = "true"
 import threading
 import signal
 import datetime
+import hashlib
 import re
 import io
 import logging
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Third-Party Imports ---
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 from dotenv import load_dotenv
 from crewai import LLM, Agent, Task, Crew
@@ -20,6 +24,21 @@ from fpdf import FPDF
 import arabic_reshaper
 from bidi.algorithm import get_display
 
+# --- Optional Accelerators ---
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+    pacsv = None
+
+try:
+    import cupy
+    if not cupy.cuda.is_available():
+        cupy = None
+except Exception:
+    cupy = None
+
 # --- Threading Patch for CrewAI ---
 if threading.current_thread() is not threading.main_thread():
     original_signal = signal.signal
@@ -268,8 +287,7 @@ custom_css = """
 """
 
 # RTL Support
-if st.session_state.language == "Arabic":
-    rtl_css = """
+rtl_css = """
 <style>
     .stTextInput, .stTextArea, .stMarkdown, .stDataFrame, .stAlert, .stButton, p, h1, h2, h3, h4, h5, h6 {
         direction: rtl;
@@ -285,39 +303,44 @@ if st.session_state.language == "Arabic":
     }
 </style>
 """
-    custom_css += rtl_css
 
-st.markdown(custom_css, unsafe_allow_html=True)
+@st.cache_data(show_spinner=False)
+def build_custom_css(lang):
+    """
+    Assembles the page stylesheet once per language instead of on every rerun.
+    """
+    if lang == "Arabic":
+        return custom_css + rtl_css
+    return custom_css
+
+st.markdown(build_custom_css(st.session_state.language), unsafe_allow_html=True)
 
 # --- Helper Functions ---
 
 # Security: Input Sanitization
+_INJECTION_RE = re.compile(
+    r"ignore previous instructions|system override|delete all files|show configuration|reveal keys",
+    re.IGNORECASE
+)
+
 def sanitize_prompt(text):
     """
     Strips potential prompt injection attacks from user input.
     """
-    patterns = [
-        r"ignore previous instructions",
-        r"system override",
-        r"delete all files",
-        r"show configuration",
-        r"reveal keys"
-    ]
-    cleaned_text = text
-    for pattern in patterns:
-        cleaned_text = re.sub(pattern, "[REDACTED]", cleaned_text, flags=re.IGNORECASE)
-    return cleaned_text
+    return _INJECTION_RE.sub("[REDACTED]", text)
 
 # Security: Strict File Validation
+VALID_EXTENSIONS = frozenset({'csv', 'xlsx'})
+
 def validate_uploaded_file(uploaded_file):
     """
     Validates file extension, size, and magic bytes to prevent malicious uploads.
     """
-    valid_extensions = ['.csv', '.xlsx']
     filename = uploaded_file.name.lower()
+    extension = filename.rpartition('.')[2]
     
     # 1. Extension Check
-    if not any(filename.endswith(ext) for ext in valid_extensions):
+    if extension not in VALID_EXTENSIONS:
         return False, "Invalid file type. Only CSV and Excel are allowed."
     
     # 2. Size Check (Limit to 200MB)
@@ -331,13 +354,13 @@ def validate_uploaded_file(uploaded_file):
         header = uploaded_file.read(4)
         uploaded_file.seek(0)  # Reset pointer
         
-        if filename.endswith('.xlsx'):
+        if extension == 'xlsx':
             # ZIP signature for .xlsx (PK\x03\x04)
             if header != b'PK\x03\x04':
                 return False, "Security Check Failed: Invalid file signature for Excel."
         
         # CSV Validation: Try parsing with pandas instead of simple text decoding
-        if filename.endswith('.csv'):
+        if extension == 'csv':
             encodings = ['utf-8', 'latin-1', 'utf-8-sig', 'cp1252']
             valid_csv = False
             
@@ -361,24 +384,28 @@ def validate_uploaded_file(uploaded_file):
         
     return True, "Valid"
 
+@st.cache_resource(show_spinner=False)
+def resolve_font_path():
+    """
+    Returns the report font path; cached across reruns so the filesystem is scanned once.
+    """
+    # Priority: Local arial.ttf > Local DejaVuSans.ttf > System arial.ttf
+    possible_fonts = [
+        "arial.ttf",
+        "DejaVuSans.ttf",
+        "C:/Windows/Fonts/arial.ttf"
+    ]
+    
+    for path in possible_fonts:
+        if os.path.exists(path):
+            return path
+    return None
+
 class PDFReport(FPDF):
     def __init__(self):
         super().__init__()
-        self.font_path = None
-        self.has_custom_font = False
-        
-        # Priority: Local arial.ttf > Local DejaVuSans.ttf > System arial.ttf
-        possible_fonts = [
-            "arial.ttf",
-            "DejaVuSans.ttf",
-            "C:/Windows/Fonts/arial.ttf"
-        ]
-        
-        for path in possible_fonts:
-            if os.path.exists(path):
-                self.font_path = path
-                self.has_custom_font = True
-                break
+        self.font_path = resolve_font_path()
+        self.has_custom_font = self.font_path is not None
         
         # Add Fonts if found
         if self.has_custom_font:
@@ -400,12 +427,17 @@ class PDFReport(FPDF):
              
         self.cell(0, 10, f'Page {self.page_no()}', 0, 0, 'C')
 
-def generate_pdf_bytes(content, title, lang="English", t_dict=None):
+# Leading Markdown header/bold markers stripped from report lines
+_MD_STRIP = re.compile(r'^[*#]+\s*')
+
+def generate_pdf_bytes(content, title, lang="English", t_dict=None, pdf=None):
     """
     Generates PDF in-memory and returns bytes. No file is written to disk.
+    An unused PDFReport may be passed in to reuse fonts loaded ahead of time.
     """
     try:
-        pdf = PDFReport()
+        if pdf is None:
+            pdf = PDFReport()
         pdf.add_page()
         
         # Title Page
@@ -435,10 +467,23 @@ def generate_pdf_bytes(content, title, lang="English", t_dict=None):
             pdf.ln(10)
 
         # Content Parsing & Formatting
-        lines = content.split('\n')
+        lines = [line.strip() for line in content.split('\n')]
+        
+        # Remove Markdown symbols for cleaner PDF
+        clean_lines = [_MD_STRIP.sub('', line).replace('**', '').strip() for line in lines]
+        
+        # Resolve per-document settings once instead of per line
+        font_family = "CustomFont" if pdf.has_custom_font else "Arial"
+        is_rtl = lang == "Arabic" and pdf.has_custom_font
+        align = 'R' if is_rtl else 'L'
         
-        for line in lines:
-            line = line.strip()
+        if is_rtl:
+            # Shape every line in a single reshaper pass; newlines never join letters, so the split is lossless
+            shaped_lines = arabic_reshaper.reshape('\n'.join(clean_lines)).split('\n')
+        else:
+            shaped_lines = clean_lines
+        
+        for line, shaped_line in zip(lines, shaped_lines):
             if not line:
                 pdf.ln(5)
                 continue
@@ -447,22 +492,11 @@ def generate_pdf_bytes(content, title, lang="English", t_dict=None):
             # Support #, ##, ###, or **Header**
             is_header = line.startswith('#') or line.startswith('**')
             
-            # Remove Markdown symbols for cleaner PDF
-            clean_line = re.sub(r'^[*#]+\s*', '', line).replace('**', '').strip()
-            
-            if lang == "Arabic" and pdf.has_custom_font:
-                reshaped_line = arabic_reshaper.reshape(clean_line)
-                bidi_line = get_display(reshaped_line)
-                align = 'R'
-            else:
-                bidi_line = clean_line
-                align = 'L'
+            # Bidi reordering stays per line: get_display resolves the base direction per paragraph
+            bidi_line = get_display(shaped_line) if is_rtl else shaped_line
 
             if is_header:
-                if pdf.has_custom_font:
-                    pdf.set_font("CustomFont", 'B', 14)
-                else:
-                    pdf.set_font("Arial", 'B', 14)
+                pdf.set_font(font_family, 'B', 14)
                 
                 # Add some spacing before header
                 pdf.ln(5)
@@ -474,53 +508,258 @@ def generate_pdf_bytes(content, title, lang="English", t_dict=None):
                 
                 pdf.ln(2)
             else:
-                if pdf.has_custom_font:
-                    pdf.set_font("CustomFont", '', 11)
-                else:
-                    pdf.set_font("Arial", '', 11)
-                
+                pdf.set_font(font_family, '', 11)
                 pdf.multi_cell(0, 8, bidi_line, align=align)
         
-        # Output to string (latin-1 encoding of the internal byte stream) and convert to bytes
-        return pdf.output(dest='S').encode('latin-1')
+        # fpdf2 already returns a bytearray; legacy PyFPDF returns a latin-1 str of the byte stream
+        output = pdf.output(dest='S')
+        if isinstance(output, (bytes, bytearray)):
+            return bytes(output)
+        return output.encode('latin-1')
         
     except Exception as e:
         logging.error(f"PDF Generation Error: {e}")
         return None
 
+@st.cache_resource(show_spinner=False)
+def get_llm():
+    """
+    Returns a process-wide LLM client so the LiteLLM backend and its connection pool are reused across analyses.
+    """
+    return LLM(
+        model="gemini/gemini-flash-latest",
+        api_key=os.getenv("GOOGLE_API_KEY")
+    )
+
+# Crew-level token streaming is only available in newer CrewAI releases
+CREW_STREAMING = "stream" in getattr(Crew, "model_fields", {})
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def run_crew_cached(intent_hash, data_hash, lang, report_date, _crew, _on_chunk=None):
+    """
+    Runs the crew once per (intent, data, language, date); retries of the same request reuse the report.
+    The crew and chunk callback are excluded from the cache key (leading underscore).
+    """
+    output = _crew.kickoff()
+    if CREW_STREAMING:
+        for chunk in output:
+            if _on_chunk is not None and chunk.content:
+                _on_chunk(chunk.content)
+        output = output.result
+    return str(output)
+
+def iter_report_chunks(chunks, report_future):
+    """
+    Yields streamed report tokens until the crew run finishes (cache hits finish without yielding).
+    """
+    while True:
+        try:
+            yield chunks.get(timeout=0.1)
+        except queue.Empty:
+            if report_future.done():
+                # Drain anything queued between the timeout and completion
+                while not chunks.empty():
+                    yield chunks.get_nowait()
+                return
+
+def run_analysis(crew, intent, data_str, lang, report_date):
+    """
+    Runs the (cached) crew and prepares the PDF document (font discovery/loading) on worker threads,
+    streaming report tokens into the current container as they arrive.
+    """
+    intent_hash = hashlib.blake2b(intent.encode("utf-8")).hexdigest()
+    data_hash = hashlib.blake2b(data_str.encode("utf-8")).hexdigest()
+    chunks = queue.Queue()
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        report_future = pool.submit(
+            run_crew_cached, intent_hash, data_hash, lang, report_date, crew, chunks.put
+        )
+        pdf_future = pool.submit(PDFReport)
+        st.write_stream(iter_report_chunks(chunks, report_future))
+        return report_future.result(), pdf_future.result()
+
+def read_csv_fast(uploaded_file):
+    """
+    Parses CSV uploads with PyArrow's multithreaded reader, falling back to pandas' C engine.
+    """
+    if pacsv is not None:
+        try:
+            uploaded_file.seek(0)
+            table = pacsv.read_csv(
+                uploaded_file,
+                read_options=pacsv.ReadOptions(block_size=8 << 20, use_threads=True)
+            )
+            # Arrow keeps duplicate header names; let pandas parse so they are mangled to 'id.1' etc.
+            has_duplicates = len(set(table.column_names)) != len(table.column_names)
+            # Invalid UTF-8 is read as binary (bytes) instead of failing; use pandas' encoding fallbacks
+            has_binary = any(
+                pa.types.is_binary(field.type) or pa.types.is_large_binary(field.type)
+                for field in table.schema
+            )
+            if not (has_duplicates or has_binary):
+                return table.to_pandas()
+        except Exception as e:
+            logging.info(f"PyArrow CSV reader fallback: {e}")
+
+    encodings = ['utf-8', 'latin-1', 'utf-8-sig', 'cp1252']
+    for encoding in encodings:
+        try:
+            uploaded_file.seek(0)
+            return pd.read_csv(uploaded_file, encoding=encoding, engine="c", low_memory=False)
+        except Exception:
+            continue
+    raise ValueError("Could not decode CSV with supported encodings.")
+
+def load_uploaded_file(uploaded_file):
+    """
+    Loads a validated upload into a DataFrame entirely in memory.
+    """
+    if uploaded_file.name.endswith('.csv'):
+        return read_csv_fast(uploaded_file)
+
+    # Calamine (Rust) is much faster than openpyxl; fall back if it is not installed
+    try:
+        uploaded_file.seek(0)
+        return pd.read_excel(uploaded_file, engine="calamine")
+    except (ImportError, ValueError):
+        uploaded_file.seek(0)
+        return pd.read_excel(uploaded_file)
+
+def truncate_lines(text, max_chars):
+    """
+    Keeps whole lines of text within max_chars and notes how many were omitted.
+    """
+    lines = text.splitlines()
+    kept, used = [], 0
+    for line in lines:
+        if used + len(line) + 1 > max_chars:
+            break
+        kept.append(line)
+        used += len(line) + 1
+    if len(kept) < len(lines):
+        kept.append(f"... ({len(lines) - len(kept)} more lines omitted)")
+    return "\n".join(kept)
+
+def build_data_summary(df, sample_rows=200, min_sample_rows=5, max_chars=16000):
+    """
+    Builds a compact schema + statistics + sample snippet for the LLM prompt instead of the full frame.
+    Schema and statistics get fixed shares of the budget; the sample keeps whole rows (at least min_sample_rows).
+    """
+    schema = truncate_lines(
+        "\n".join(f"- {col}: {dtype}" for col, dtype in df.dtypes.to_dict().items()),
+        max_chars // 5
+    )
+    # Transposed so each column is one line and truncation never cuts the table mid-row
+    stats = truncate_lines(df.describe(include="all").T.to_string(), max_chars * 2 // 5)
+
+    header = (
+        f"Rows: {len(df)} | Columns: {len(df.columns)}\n\n"
+        f"Schema:\n{schema}\n\n"
+        f"Summary Statistics:\n{stats}\n\n"
+        f"Sample Rows (CSV):\n"
+    )
+
+    # Trim sample rows (not characters) until the remaining budget fits
+    budget = max_chars - len(header)
+    sample = df.sample(n=min(sample_rows, len(df)), random_state=0)
+    sample_csv = sample.to_csv(index=False)
+    while len(sample_csv) > budget and len(sample) > min_sample_rows:
+        n = int(len(sample) * budget / len(sample_csv))
+        sample = sample.iloc[:max(min_sample_rows, min(n, len(sample) - 1))]
+        sample_csv = sample.to_csv(index=False)
+
+    return header + sample_csv
+
+def compute_correlation(num_df, max_rows=50_000):
+    """
+    Computes the correlation matrix on an (optionally down-sampled) float64 array of the numeric columns.
+    """
+    cols = num_df.columns
+    # float64 to match np.corrcoef's internal precision; float32 would only add a copy on the CPU path
+    arr = num_df.to_numpy(dtype=np.float64, na_value=np.nan)
+    if len(arr) > max_rows:
+        arr = arr[np.random.default_rng(0).choice(len(arr), max_rows, replace=False)]
+
+    # np.corrcoef propagates NaN; keep pandas' pairwise handling for frames with missing values
+    if np.isnan(arr).any():
+        return pd.DataFrame(arr, columns=cols).corr()
+
+    # Dense correlation is GEMM-shaped; offload it when a CUDA device is present
+    if cupy is not None:
+        try:
+            return pd.DataFrame(cupy.asnumpy(cupy.corrcoef(cupy.asarray(arr, dtype=cupy.float32), rowvar=False)),
+                                index=cols, columns=cols)
+        except Exception as e:
+            logging.error(f"GPU correlation fallback: {e}")
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = np.corrcoef(arr, rowvar=False)
+    return pd.DataFrame(corr, index=cols, columns=cols)
+
+# Adaptive Chart Theme - Permanent Dark
+CHART_THEME = "plotly_dark"
+CHART_COLORS = ['#20B2AA', '#008080', '#40E0D0']
+
+def get_session_figure(df_hash, key, builder, *args):
+    """
+    Returns a figure memoized in this session for the current upload.
+    Figures of earlier uploads are dropped, and all of them are freed when the session ends.
+    """
+    cache = st.session_state.get("figure_cache")
+    if cache is None or cache["df_hash"] != df_hash:
+        cache = st.session_state.figure_cache = {"df_hash": df_hash, "figures": {}}
+    if key not in cache["figures"]:
+        cache["figures"][key] = builder(*args)
+    return cache["figures"][key]
+
+def build_histogram(df, col, title):
+    fig = px.histogram(df, x=col, title=title, 
+                       color_discrete_sequence=CHART_COLORS, template=CHART_THEME)
+    # Ensure seamless background
+    fig.update_layout(paper_bgcolor="rgba(0,0,0,0)", plot_bgcolor="rgba(0,0,0,0)")
+    return fig
+
+def build_correlation_heatmap(df, cols, title):
+    fig = px.imshow(compute_correlation(df[list(cols)]), text_auto=True, title=title, 
+                    color_continuous_scale='Teal', template=CHART_THEME)
+    fig.update_layout(paper_bgcolor="rgba(0,0,0,0)", plot_bgcolor="rgba(0,0,0,0)")
+    return fig
+
+def build_top_categories(df, col, title):
+    # Unsorted counts + nlargest is a partial (top-k) selection rather than a full sort of every category
+    top_counts = df[col].value_counts(sort=False).nlargest(10)
+    fig = px.bar(top_counts, x=top_counts.index, y=top_counts.values, 
+                 title=title,
+                 labels={'x': col, 'y': 'Count'},
+                 color_discrete_sequence=CHART_COLORS, template=CHART_THEME)
+    fig.update_layout(paper_bgcolor="rgba(0,0,0,0)", plot_bgcolor="rgba(0,0,0,0)")
+    return fig
+
 def visualize_data(df, t_dict):
     st.markdown(t_dict["visuals_header"])
     
-    num_cols = df.select_dtypes(include=['float64', 'int64']).columns
-    cat_cols = df.select_dtypes(include=['object', 'category']).columns
-
-    # Adaptive Chart Theme - Permanent Dark
-    chart_theme = "plotly_dark"
-    color_seq = ['#20B2AA', '#008080', '#40E0D0']
+    num_cols = df.select_dtypes(include="number").columns
+    cat_cols = df.select_dtypes(include=['object', 'category', 'string']).columns
+    df_hash = st.session_state.df_hash
 
     if len(num_cols) > 0:
         st.info(t_dict["num_cols"].format(cols=', '.join(num_cols)))
         
-        fig_hist = px.histogram(df, x=num_cols[0], title=t_dict["dist_title"].format(col=num_cols[0]), 
-                                color_discrete_sequence=color_seq, template=chart_theme)
-        # Ensure seamless background
-        fig_hist.update_layout(paper_bgcolor="rgba(0,0,0,0)", plot_bgcolor="rgba(0,0,0,0)")
+        title = t_dict["dist_title"].format(col=num_cols[0])
+        fig_hist = get_session_figure(df_hash, ("hist", num_cols[0], title), build_histogram, df, num_cols[0], title)
         st.plotly_chart(fig_hist, width="stretch")
         
         if len(num_cols) > 1:
-            fig_corr = px.imshow(df[num_cols].corr(), text_auto=True, title=t_dict["corr_title"], 
-                                 color_continuous_scale='Teal', template=chart_theme)
-            fig_corr.update_layout(paper_bgcolor="rgba(0,0,0,0)", plot_bgcolor="rgba(0,0,0,0)")
+            cols = tuple(num_cols)
+            fig_corr = get_session_figure(df_hash, ("corr", cols, t_dict["corr_title"]),
+                                          build_correlation_heatmap, df, cols, t_dict["corr_title"])
             st.plotly_chart(fig_corr, width="stretch")
 
     if len(cat_cols) > 0:
         st.info(t_dict["cat_cols"].format(cols=', '.join(cat_cols)))
-        top_counts = df[cat_cols[0]].value_counts().nlargest(10)
-        fig_bar = px.bar(top_counts, x=top_counts.index, y=top_counts.values, 
-                         title=t_dict["top_10"].format(col=cat_cols[0]),
-                         labels={'x': cat_cols[0], 'y': 'Count'},
-                         color_discrete_sequence=color_seq, template=chart_theme)
-        fig_bar.update_layout(paper_bgcolor="rgba(0,0,0,0)", plot_bgcolor="rgba(0,0,0,0)")
+        title = t_dict["top_10"].format(col=cat_cols[0])
+        fig_bar = get_session_figure(df_hash, ("bar", cat_cols[0], title), build_top_categories, df, cat_cols[0], title)
         st.plotly_chart(fig_bar, width="stretch")
 
 # --- Main Layout ---
@@ -549,19 +788,17 @@ with tab1:
         else:
             try:
                 # Security: In-Memory Processing (No disk save)
-                if uploaded_file.name.endswith('.csv'):
-                    encodings = ['utf-8', 'latin-1', 'utf-8-sig', 'cp1252']
-                    for encoding in encodings:
-                        try:
-                            uploaded_file.seek(0)
-                            df = pd.read_csv(uploaded_file, encoding=encoding)
-                            break
-                        except Exception:
-                            continue
-                    else:
-                         raise ValueError("Could not decode CSV with supported encodings.")
-                else:
-                    df = pd.read_excel(uploaded_file)
+                df = load_uploaded_file(uploaded_file)
+                # Fingerprint the upload once: a sample hash plus shape/columns instead of hashing every row per rerun.
+                # The upload id keeps a re-upload with the same head/shape from reusing stale figures.
+                if st.session_state.get("df_file_id") != uploaded_file.file_id:
+                    st.session_state.df_file_id = uploaded_file.file_id
+                    st.session_state.df_hash = (
+                        int(pd.util.hash_pandas_object(df.head(256), index=False).sum())
+                        ^ (len(df) << 32)
+                        ^ hash(tuple(df.columns))
+                        ^ hash(uploaded_file.file_id)
+                    )
                 
                 st.success(t["file_uploaded"].format(filename=uploaded_file.name))
                 st.markdown(t["data_preview"])
@@ -603,10 +840,7 @@ with tab2:
                 
                 with st.status(t["status_active"], expanded=True) as status:
                     
-                    my_llm = LLM(
-                        model="gemini/gemini-flash-latest",
-                        api_key=os.getenv("GOOGLE_API_KEY")
-                    )
+                    my_llm = get_llm()
                     
                     status.write(t["status_persona"])
                     dynamic_role = f"Expert Analyst - {user_intent[:40]}..."
@@ -625,7 +859,7 @@ with tab2:
                     )
                     
                     status.write(t["status_task"])
-                    data_str = df.to_string()
+                    data_str = build_data_summary(df)
                     current_date = datetime.date.today()
                     
                     analysis_task = Task(
@@ -648,12 +882,15 @@ with tab2:
                     )
                     
                     status.write(t["status_thinking"])
+                    crew_options = {"stream": True} if CREW_STREAMING else {}
                     my_crew = Crew(
                         agents=[specialized_agent],
-                        tasks=[analysis_task]
+                        tasks=[analysis_task],
+                        **crew_options
                     )
                     
-                    result = my_crew.kickoff()
+                    # Tokens stream into the status panel; the final report is rendered below once complete
+                    result, pdf_report = run_analysis(my_crew, user_intent, data_str, language, str(current_date))
                     status.update(label=t["status_complete"], state="complete", expanded=False)
                 
                 st.success(t["success_msg"])
@@ -671,7 +908,7 @@ with tab2:
                 pdf_internal_title = user_intent[:50]
                 
                 # Security: Generate PDF in memory
-                pdf_bytes = generate_pdf_bytes(str(result), pdf_internal_title, lang=language, t_dict=t)
+                pdf_bytes = generate_pdf_bytes(str(result), pdf_internal_title, lang=language, t_dict=t, pdf=pdf_report)
                 
                 if pdf_bytes:
                     st.download_button(